@@ -3,28 +3,84 @@
 sense.py: log and output sensor values
 """
 
-import collections
+import functools
 import logging
-from statistics import mean
+import math
 import time
 import threading
 import os
+import shutil
 import sys
 
-import psutil
-import sensors
-import urwid
-
 from util import confighandler
-from workers import cpu_msr
-from workers import nvidia_smi
+from workers import cpu_stats
+
+# Sensor types whose values are shown rounded to integers
+INT_TYPES = frozenset(("fan", "freq", "usage", "temp"))
+
+# Availability of the optional measurement sources, checked once
+MSR_PATH = "/dev/cpu/0/msr"
+HAS_MSR = os.path.exists(MSR_PATH) and os.access(MSR_PATH, os.R_OK)
+HAS_NVIDIA_SMI = shutil.which("nvidia-smi") is not None
+
+
+def init_readouts(unit, sensor_type, table, row):
+    """
+    Return the readouts of a single sensor, with the row of the sensor table
+    that holds its measurements and the cur, min, max and avg text widgets
+    that display it.
+    """
+
+    import urwid
+
+    return {
+        "info": {"unit": unit, "type": sensor_type},
+        "table": table,
+        "row": row,
+        "widgets": tuple(urwid.Text("") for _ in range(4)),
+        "_fmt": field_formatter(unit, sensor_type),
+        "_shown": None,
+    }
+
+
+def init_group(sensors, queue_length):
+    """
+    Return the readouts of a group of sensors that are measured together,
+    keyed by sensor name, from a list of (name, unit, type) tuples. They
+    share a sensor table, in which every sensor gets its own row.
+    """
+
+    # Imported here, as numpy (and numba, if installed) are only needed once
+    # the sensors are set up
+    from util.sensortable import SensorTable
+
+    table = SensorTable(len(sensors), queue_length)
+
+    group = {}
+    for row, (name, unit, sensor_type) in enumerate(sensors):
+        group[name] = init_readouts(unit, sensor_type, table, row)
 
+    return group
 
-def init_history(chips, blacklist, queue_length):
+
+def get_table(group):
+    """
+    Return the sensor table shared by a group of readouts.
+    """
+
+    return next(iter(group.values()))["table"]
+
+
+def init_history(chips, blacklist, queue_length, gpus=()):
     """
     Build a history tree that will collect all the measurements.
+
+    `gpus` is a status of the nVidia GPU(s), as returned by the latest()
+    method of the GPU source, and is only used to enumerate their sensors.
     """
 
+    import psutil
+
     # Adapted from lm-sensors source code
     # Utility lists to map from lm-sensors type to units
     sensor_units = [" V", " RPM", " °C", "", "", "", "", " V", " ", "", "", "", "", ""]
@@ -34,9 +90,10 @@ def init_history(chips, blacklist, queue_length):
 
     tree = {}
     for chip in chips:
-        sensor_dict = {}
+        sensors = []
         for feature in chip:
-            if feature.label in blacklist:
+            label = feature.label
+            if label in blacklist:
                 continue
 
             try:
@@ -46,182 +103,299 @@ def init_history(chips, blacklist, queue_length):
                 unit = " ???"
                 sensor_type = " ???"
 
-            sensor_dict[feature.label] = {}
-            sensor_dict[feature.label]["info"] = {"unit": unit, "type": sensor_type}
-            sensor_dict[feature.label]["measurements"] = collections.deque(maxlen=queue_length)
+            sensors.append((label, unit, sensor_type))
 
-        tree[str(chip)] = sensor_dict
+        tree[str(chip)] = init_group(sensors, queue_length)
 
-    msr_path = "/dev/cpu/0/msr"
-    if "msr" not in blacklist \
-        and os.path.exists(msr_path) \
-        and os.access(msr_path, os.R_OK):
+    core_ids = ["Core #{}".format(cpu) for cpu in range(psutil.cpu_count())]
 
-        tree["CPU VCCIN"] = {}
-        for cpu in range(psutil.cpu_count()):
-            core_id = "Core #{}".format(cpu)
-            tree["CPU VCCIN"][core_id] = {}
-            tree["CPU VCCIN"][core_id]["info"] = {"unit": " V", "type": "voltage"}
-            tree["CPU VCCIN"][core_id]["measurements"] = collections.deque(maxlen=queue_length)
+    if "msr" not in blacklist and HAS_MSR:
+        tree["CPU VCCIN"] = init_group([(core_id, " V", "voltage") for core_id in core_ids],
+                                       queue_length)
     else:
         logging.warning("No access to MSR. Either run as root, enable reading "
-                        f"capabilites for {msr_path} or add 'msr' to blacklist to "
+                        f"capabilites for {MSR_PATH} or add 'msr' to blacklist to "
                         "disable reading the MSR.  Press enter to continue.")
         input()
 
-    tree["CPU Usage"] = {}
-    for cpu in range(psutil.cpu_count()):
-        core_id = "Core #{}".format(cpu)
-        tree["CPU Usage"][core_id] = {}
-        tree["CPU Usage"][core_id]["info"] = {"unit": " %", "type": "usage"}
-        tree["CPU Usage"][core_id]["measurements"] = collections.deque(maxlen=queue_length)
-
-    tree["CPU Frequency"] = {}
-    for cpu in range(psutil.cpu_count()):
-        core_id = "Core #{}".format(cpu)
-        tree["CPU Frequency"][core_id] = {}
-        tree["CPU Frequency"][core_id]["info"] = {"unit": " MHz", "type": "freq"}
-        tree["CPU Frequency"][core_id]["measurements"] = collections.deque(maxlen=queue_length)
-
-    if "nvidia-smi" not in blacklist and os.path.exists("/usr/bin/nvidia-smi"):
-        for gpu in nvidia_smi.get_nvidia_smi_log():
-            tree[gpu["GPU ID"]] = {}
-            for sensor in gpu:
-                if sensor == "GPU ID":
-                    continue
-
-                tree[gpu["GPU ID"]][sensor] = {}
-                tree[gpu["GPU ID"]][sensor]["info"] = {"unit": gpu[sensor]["unit"],
-                                                       "type": gpu[sensor]["type"]}
-                tree[gpu["GPU ID"]][sensor]["measurements"] = collections.deque(maxlen=queue_length)
+    tree["CPU Usage"] = init_group([(core_id, " %", "usage") for core_id in core_ids],
+                                   queue_length)
+    tree["CPU Frequency"] = init_group([(core_id, " MHz", "freq") for core_id in core_ids],
+                                       queue_length)
+
+    for gpu in gpus:
+        sensors = [(sensor, gpu[sensor]["unit"], gpu[sensor]["type"])
+                   for sensor in gpu if sensor != "GPU ID"]
+        tree[gpu["GPU ID"]] = init_group(sensors, queue_length)
 
     return tree
 
 
-def update_readouts(current_value, readouts):
+def bind_features(chips, history):
     """
-    Updates the min, max and average values of the readouts
+    Return a list of (table, getters) pairs for every chip with features
+    kept in the history, where getters read the value of every row of the
+    table, so that updating them needs no lookups.
+
+    PySensors' Feature.get_value() enumerates all the subfeatures of the
+    feature through libsensors on every call just to read the first one, so
+    that subfeature is resolved here once and read directly afterwards.
     """
-    measurements = readouts["measurements"]
-    readouts["measurements"].append(current_value)
-    readouts["cur"] = current_value
 
-    if "min" in readouts:
-        readouts["min"] = min(*measurements, readouts["min"])
-    else:
-        readouts["min"] = current_value
+    features = []
+    for chip in chips:
+        sensor_dict = history[str(chip)]
+        if not sensor_dict:
+            continue
 
-    if "max" in readouts:
-        readouts["max"] = max(*measurements, readouts["max"])
-    else:
-        readouts["max"] = current_value
+        getters = [None] * len(sensor_dict)
+        for feature in chip:
+            readouts = sensor_dict.get(feature.label)
+            if readouts is not None:
+                subfeature = next(iter(feature))
+                getters[readouts["row"]] = subfeature.get_value
 
-    if "avg" in readouts:
-        readouts["avg"] = mean(measurements)
-    else:
-        readouts["avg"] = current_value
+        features.append((get_table(sensor_dict), getters))
 
-    return readouts
+    return features
 
 
-def update_history(history, chips):
+def update_chips(features):
     """
-    Iterate through the chips and add the measurements to the history.
+    Add the current measurements of the chip features to the history.
     """
 
-    for chip in chips:
-        for feature in chip:
-            if feature.label not in history[str(chip)].keys():
-                continue
-            readouts = history[str(chip)][feature.label]
-            current_value = feature.get_value()
-            readouts = update_readouts(current_value, readouts)
-
-    for i, current_value in enumerate(psutil.cpu_percent(percpu=True)):
-        core_id = "Core #{}".format(i)
-        readouts = history["CPU Usage"][core_id]
-        readouts = update_readouts(current_value, readouts)
-
-    for i, freq in enumerate(psutil.cpu_freq(percpu=True)):
-        core_id = "Core #{}".format(i)
-        readouts = history["CPU Frequency"][core_id]
-        current_value = float(round(freq.current))
-        readouts = update_readouts(current_value, readouts)
-
-    try:
-        for core in range(psutil.cpu_count()):
-            core_id = "Core #{}".format(core)
-            current_value = cpu_msr.get_vccin(core)
-            readouts = history["CPU VCCIN"][core_id]
-            readouts = update_readouts(current_value, readouts)
-    except KeyError:
-        # We haven't loaded the `msr` module or there's no MSR support on our
-        # machine.
-        pass
-
-    nvidia_gpus = None
-    if os.path.exists("/usr/bin/nvidia-smi"):
-        nvidia_gpus = nvidia_smi.get_nvidia_smi_log()
-    if nvidia_gpus:
-        for gpu in nvidia_gpus:
-            for sensor in gpu:
-                if sensor == "GPU ID":
-                    continue
-
-                readouts = history[gpu["GPU ID"]][sensor]
-                current_value = float(gpu[sensor]["value"].split()[0])
-                readouts = update_readouts(current_value, readouts)
+    for table, getters in features:
+        table.update([get_value() for get_value in getters])
+
+
+def update_cpu(history):
+    """
+    Add the current CPU usage and frequency measurements to the history.
+    """
+
+    usage_table = get_table(history["CPU Usage"])
+    usage_table.update(cpu_stats.get_cpu_usages(len(usage_table)))
+
+    frequency_table = get_table(history["CPU Frequency"])
+    freqs = cpu_stats.get_cpu_freqs(len(frequency_table))
+    frequency_table.update([float(round(freq)) for freq in freqs])
+
+
+def update_msr(history):
+    """
+    Add the current VCCIN measurements read from the MSR to the history.
+    """
+
+    from workers import cpu_msr
+
+    table = get_table(history["CPU VCCIN"])
+    vccins = (cpu_msr.get_vccin(core) for core in range(len(table)))
+
+    # A failed read is stored as NaN, so it doesn't count into min/max/avg
+    table.update([math.nan if vccin is None else vccin for vccin in vccins])
+
+
+def update_nvidia(history, nvidia):
+    """
+    Add the last status reported by nvidia-smi to the history.
+    """
+
+    update_gpus(history, nvidia.latest())
+
+
+def update_gpus(history, gpus):
+    """
+    Add a status of the nVidia GPU(s) to the history.
+    """
+
+    for gpu in gpus:
+        group = history[gpu["GPU ID"]]
+        get_table(group).update([gpu[sensor]["value"] for sensor in group])
+
+
+def update_history(history, features, nvidia=None):
+    """
+    Add the current measurements of every source to the history.
+    """
+
+    update_chips(features)
+    update_cpu(history)
+    if "CPU VCCIN" in history:
+        update_msr(history)
+    if nvidia:
+        update_nvidia(history, nvidia)
 
     return history
 
 
-def update_footer(date_fmt, quit_hint):
+def poll(update, delay, stop):
+    """
+    Call `update` every `delay` seconds until `stop` is set.
+
+    The schedule is kept on the monotonic clock, so the time spent in
+    `update` doesn't add up into drift. Updates that couldn't run in time
+    are skipped rather than run in a burst.
+
+    A failing update, e.g. a sensor read error, doesn't stop the polling:
+    it's logged once, to the log file set up by main(), and retried on the
+    next update until it succeeds.
+    """
+
+    failing = False
+    next_time = time.monotonic() + delay
+    while not stop.wait(max(0.0, next_time - time.monotonic())):
+        try:
+            update()
+        except Exception:
+            if not failing:
+                logging.exception("Couldn't update the measurements, retrying")
+            failing = True
+        else:
+            failing = False
+
+        next_time = max(next_time + delay, time.monotonic())
+
+
+def start_pollers(history, features, nvidia, delay):
+    """
+    Start one thread per measurement source that keeps adding measurements to
+    the history, so that a slow source never holds up the interface, which
+    only displays the last known values. Return an event that stops them,
+    and the threads, to be joined once stopped.
+
+    Each sensor table is only written by the thread of its own source, so
+    no locking is needed.
+    """
+
+    updates = [functools.partial(update_chips, features),
+               functools.partial(update_cpu, history)]
+    if "CPU VCCIN" in history:
+        updates.append(functools.partial(update_msr, history))
+    if nvidia:
+        updates.append(functools.partial(update_nvidia, history, nvidia))
+
+    stop = threading.Event()
+    pollers = []
+    for update in updates:
+        poller = threading.Thread(target=poll, args=(update, delay, stop), daemon=True)
+        poller.start()
+        pollers.append(poller)
+
+    return stop, pollers
+
+
+def init_footer(quit_hint):
     """
-    Create a footer with the program name, the current date and time
-    and a small hint to quit.
+    Create a footer with the program name, a placeholder for the current
+    date and time and a small hint to quit. Return the footer and its date
+    widget.
     """
 
+    import urwid
+
+    date = urwid.Text("", align="center")
+
     title = urwid.AttrMap(urwid.Text("sense.py", align="left"), "title")
-    date = urwid.AttrMap(urwid.Text(time.strftime(date_fmt), align="center"), "date")
     quit_hint = urwid.AttrMap(urwid.Text(quit_hint, align="right"), "quit_hint")
-    return urwid.Columns((title, date, quit_hint))
+    footer = urwid.Columns((title, urwid.AttrMap(date, "date"), quit_hint))
+
+    return footer, date
 
 
-def format_field(number, unit, s_type):
+def update_footer(date, date_fmt):
     """
-    Make an urwid text out of a number and unit suitable for putting into columns.
+    Show the current date and time in the footer.
     """
 
-    if s_type in ("fan", "freq", "usage", "temp"):
-        field = "{:>7d}{:<3}".format(round(number), unit)
-    else:
-        field = "{:>7.3f}{:<3}".format(number, unit)
+    text = time.strftime(date_fmt)
+    if text != date.text:
+        date.set_text(text)
+
+
+def field_format(unit, s_type):
+    """
+    Return a format string for a number and unit suitable for putting into columns.
+    """
+
+    if s_type in INT_TYPES:
+        return "{:>7d}" + "{:<3}".format(unit)
+
+    return "{:>7.3f}" + "{:<3}".format(unit)
+
+
+def field_formatter(unit, s_type):
+    """
+    Return a function that formats a value of a sensor with field_format(),
+    rounding it first if the sensor is shown as an integer. The choice is
+    made once per sensor, so formatting a value doesn't depend on its type.
+
+    Integer readouts repeat a lot, since their cur, min and max take only a
+    few distinct values over a session, so their fields are cached.
+
+    Values that aren't finite, from sensors that couldn't be read, are shown
+    as "N/A".
+    """
+
+    fmt = field_format(unit, s_type).format
+    if s_type in INT_TYPES:
+        cached_fmt = functools.lru_cache(maxsize=64)(fmt)
+        fmt = lambda value: cached_fmt(round(value))
 
-    return urwid.Text(field)
+    missing = "{:>7}{:<3}".format("N/A", unit)
 
+    def format_field(value):
+        if not math.isfinite(value):
+            return missing
+        return fmt(value)
 
-def calculate_values(sensor_data):
+    return format_field
+
+
+def calculate_values(sensor_data, values):
     """
-    Return desired values from a measurements list, u
+    Return the formatted cur, min, max and avg values of a sensor.
+    """
+
+    fmt = sensor_data["_fmt"]
+
+    return [fmt(value) for value in values]
+
+
+def refresh_widgets(history):
     """
+    Update the text of the value widgets of every sensor in-place.
 
-    sensor_info = sensor_data["info"]
-    sensor_unit = sensor_info["unit"]
-    sensor_type = sensor_info["type"]
+    Sensors whose readouts didn't change since the last refresh, which is
+    most of them for steady fans, clocks and idle usages, are skipped
+    without formatting anything. Otherwise only the widgets whose text
+    changed are touched, so urwid can reuse the cached canvases of all the
+    others when redrawing.
+    """
 
-    cur_value = format_field(sensor_data["cur"], sensor_unit, sensor_type)
-    min_value = format_field(sensor_data["min"], sensor_unit, sensor_type)
-    max_value = format_field(sensor_data["max"], sensor_unit, sensor_type)
-    avg_value = format_field(sensor_data["avg"], sensor_unit, sensor_type)
+    for chip in history.values():
+        for sensor_data in chip.values():
+            table = sensor_data["table"]
+            row = sensor_data["row"]
+            values = (table.cur[row], table.min[row], table.max[row], table.avg[row])
+            if values == sensor_data["_shown"]:
+                continue
+            sensor_data["_shown"] = values
 
-    return cur_value, min_value, max_value, avg_value
+            texts = calculate_values(sensor_data, values)
+            for widget, text in zip(sensor_data["widgets"], texts):
+                if text != widget.text:
+                    widget.set_text(text)
 
 
 def format_output(history):
     """
-    Format the history dict into a series of urwid columns and cells
+    Format the history dict into a series of urwid columns and cells. Only
+    needs to be called once, as the value cells are the readouts' own widgets.
     """
 
+    import urwid
+
     out = []
 
     for chip in history:
@@ -234,9 +408,7 @@ def format_output(history):
             symbol = "\u2514" if is_last else "\u251c"
 
             feature_data = history[chip][feature]
-            values = calculate_values(feature_data)
-
-            data_fields = urwid.Columns(values)
+            data_fields = urwid.Columns(feature_data["widgets"])
 
             line = urwid.Columns(((2, urwid.AttrMap(urwid.Text(symbol), "symbol")),
                                   (16, urwid.AttrMap(urwid.Text(feature), "sensor")),
@@ -246,25 +418,39 @@ def format_output(history):
         # Show an empty line between sensors
         out.append(urwid.Text(""))
 
-    return urwid.SimpleListWalker([w for w in out])
+    return urwid.SimpleListWalker(out)
 
 
-def update_frame(frame, loop, listwalker, chips, history, config):
-    """ Loop that replaces the frame listwalker in-place. """
-    while True:
-        history = update_history(history, chips)
-        listwalker[:] = format_output(history)
-        frame.footer = update_footer(config["date_format"], config["quit_hint"])
-        try:
-            loop.draw_screen()
-            time.sleep(config["update_delay"])
-        except AssertionError:  # Urwid thread breaking, for instance
-            break
+def update_frame(loop, user_data):
+    """
+    Alarm callback that shows the last measurements in the sensor widgets
+    and schedules the next update. urwid redraws the screen once the
+    callback returns.
+    """
+
+    date, history, config = user_data
+
+    refresh_widgets(history)
+    update_footer(date, config["date_format"])
 
+    schedule_frame(loop, config["update_delay"], user_data)
+
+
+def schedule_frame(loop, delay, user_data):
+    """
+    Schedule the next frame update at the next multiple of `delay` on the
+    wall clock, so that updates don't drift away from the displayed time.
+    """
+
+    next_time = (math.floor(time.time() / delay) + 1) * delay
+    loop.set_alarm_at(next_time, update_frame, user_data)
 
 
 def key_handler(key):
     """ Handle keys such as q and Q for quit, etc."""
+
+    import urwid
+
     if key in ("q", "Q"):
         raise urwid.ExitMainLoop()
 
@@ -277,15 +463,36 @@ def main():
     config = confighandler.get_config()
     if not config: sys.exit()
 
+    import sensors
+    import urwid
+
     # Initialize the sensors and the history
     sensors.init()
     chips = [chip for chip in sensors.iter_detected_chips()]
+
+    # Query NVML directly, or keep a single nvidia-smi process around instead
+    # of forking one per update
+    nvidia = None
+    if "nvidia-smi" not in config["blacklist"] and HAS_NVIDIA_SMI:
+        from workers import nvidia_smi
+
+        nvidia = nvidia_smi.open_gpu_log(config["update_delay"])
+
+    # The same GPU status both enumerates the GPU sensors and fills in their
+    # first readouts, instead of querying the GPU(s) twice at startup
+    gpus = nvidia.latest() if nvidia else []
+
     history = init_history(chips,
                            config["blacklist"],
-                           config["queue_length"])
-    history = update_history(history, chips)
-
-    # Create the output handler and a preliminary output
+                           config["queue_length"],
+                           gpus)
+    features = bind_features(chips, history)
+    history = update_history(history, features)
+    update_gpus(history, gpus)
+    refresh_widgets(history)
+
+    # Build the output once, the sensor topology doesn't change afterwards and
+    # refresh_widgets only updates the value widgets in-place
     listwalker = format_output(history)
     body = urwid.ListBox(listwalker)
 
@@ -298,17 +505,35 @@ def main():
                             (16, urwid.Text("")),
                             urwid.Columns(header)))
 
-    frame = urwid.Frame(body, header=header)
+    footer, date = init_footer(config["quit_hint"])
+    update_footer(date, config["date_format"])
+
+    frame = urwid.Frame(body, header=header, footer=footer)
     loop = urwid.MainLoop(frame, unhandled_input=key_handler,
                           palette=config["palette"])
 
-    # Create the thread that will update the frame periodically
-    frame_updater = threading.Thread(target=update_frame,
-                                     args=(frame, loop, listwalker, chips,
-                                           history, config))
-    frame_updater.start()
+    # urwid owns the terminal from now on, so log the errors of the pollers
+    # to a file instead of writing them over the screen
+    log_file = os.path.join(confighandler.get_config_dir(), "sense.log")
+    logging.basicConfig(filename=log_file, force=True,
+                        format="%(asctime)s %(levelname)s: %(message)s")
+
+    # Poll the sensors in the background and update the frame periodically
+    # from urwid's own event loop
+    stop_pollers, pollers = start_pollers(history, features, nvidia,
+                                          config["update_delay"])
+    schedule_frame(loop, config["update_delay"], (date, history, config))
     loop.run()
 
+    # Let the pollers finish their current update before the GPU source and
+    # the MSR files they read from are closed
+    stop_pollers.set()
+    for poller in pollers:
+        poller.join()
+
+    if nvidia:
+        nvidia.close()
+
 
 if __name__ == "__main__":
     main()
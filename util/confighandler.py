@@ -1,7 +1,7 @@
+import functools
 import os
 import logging
-
-import yaml
+import shutil
 
 
 DEFAULT_CONFIG = {
@@ -77,7 +77,11 @@ def parse_config(source):
     Return a configuration dictionary from a yaml source.
     """
 
-    yaml_config = yaml.load(source, Loader=yaml.FullLoader)
+    import yaml
+
+    # CSafeLoader is only available when PyYAML was built against libyaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    yaml_config = yaml.load(source, Loader=loader)
     config = {}
 
     for item in yaml_config:
@@ -90,6 +94,30 @@ def parse_config(source):
     return config
 
 
+@functools.lru_cache(maxsize=1)
+def load_config_file(config_file, mtime):
+    """
+    Return the configuration dictionary parsed from `config_file`.
+
+    `mtime` is only part of the cache key, so the file is parsed again
+    once it has been modified.
+    """
+
+    with open(config_file) as f:
+        return parse_config(f.read())
+
+
+def get_config_dir():
+    """
+    Return the directory of the configuration file, which also holds the log.
+    """
+
+    default_xdg_config_dir = os.path.join(os.getenv("HOME"), ".config")
+    xdg_config_dir = os.getenv("XDG_CONFIG_DIR", default_xdg_config_dir)
+
+    return os.path.join(xdg_config_dir, "sense")
+
+
 def get_config():
     """
     Return a config dictionary from either a readable yaml
@@ -97,14 +125,12 @@ def get_config():
     """
 
     default_xdg_config_dir = os.path.join(os.getenv("HOME"), ".config")
-    xdg_config_dir = os.getenv("XDG_CONFIG_DIR", default_xdg_config_dir)
 
-    config_dir = os.path.join(xdg_config_dir, "sense")
+    config_dir = get_config_dir()
     config_file = os.path.join(config_dir, "config.yaml")
 
     if os.path.exists(config_file):
-        with open(config_file) as f:
-            config = parse_config(f.read())
+        config = load_config_file(config_file, os.path.getmtime(config_file))
     else:
         if not os.path.isdir(default_xdg_config_dir):
             os.mkdir(default_xdg_config_dir)
@@ -112,13 +138,16 @@ def get_config():
         if not os.path.isdir(config_dir):
             os.mkdir(config_dir)
 
+        import yaml
+
         config = DEFAULT_CONFIG
 
-        if not os.path.exists("/usr/bin/nvidia-smi"):
+        if shutil.which("nvidia-smi") is None:
             config["blacklist"].append("nvidia-smi")
 
+        dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
         with open(config_file, "w") as f:
-            f.writelines(yaml.dump(config))
+            f.writelines(yaml.dump(config, Dumper=dumper))
 
         msg = ("Couldn't find a config file at the expected location {}, so "
                "a sample configuration was written there. Feel free to edit it. "
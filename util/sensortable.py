@@ -0,0 +1,140 @@
+import math
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def update_stats(buffers, head, full, values, cur, mins, maxs, sums, samples, avgs):
+    """
+    Store a row of values in the ring buffer and update every statistic of
+    each sensor in a single pass.
+
+    Only used compiled with numba, as a plain Python loop it would be much
+    slower than the NumPy operations of SensorTable.update().
+    """
+
+    for i in range(cur.shape[0]):
+        if full and not math.isnan(buffers[head, i]):
+            sums[i] -= buffers[head, i]
+            samples[i] -= 1
+
+        buffers[head, i] = values[i]
+        value = values[i]
+        cur[i] = value
+
+        if not math.isnan(value):
+            # Sum the value as stored, so that evicting it later is exact
+            sums[i] += buffers[head, i]
+            samples[i] += 1
+            if value < mins[i]:
+                mins[i] = value
+            if value > maxs[i]:
+                maxs[i] = value
+
+        avgs[i] = sums[i] / samples[i] if samples[i] else math.nan
+
+
+if njit is not None:
+    # No fastmath: it assumes there are no infinities, which min and max
+    # start at
+    update_stats = njit(cache=True)(update_stats)
+else:
+    update_stats = None
+
+
+class SensorTable:
+    """
+    Readouts of a group of sensors that are measured together, stored as one
+    array per statistic with a row per sensor.
+
+    The last measurements are kept in a (queue_length, sensors) float32 ring
+    buffer, so that every update writes a single contiguous row.
+
+    A NaN value stands for a failed measurement: it's shown as the current
+    value, but left out of min, max and the average, which only count the
+    valid samples of each sensor.
+    """
+
+    __slots__ = ("buffers", "head", "count", "cur", "min", "max", "sum",
+                 "samples", "avg")
+
+    def __init__(self, size, queue_length):
+        self.buffers = np.empty((queue_length, size), dtype=np.float32)
+        self.head = 0
+        self.count = 0
+
+        self.cur = np.zeros(size)
+        self.min = np.full(size, np.inf)
+        self.max = np.full(size, -np.inf)
+        self.sum = np.zeros(size)
+        self.samples = np.zeros(size, dtype=np.int64)
+        self.avg = np.zeros(size)
+
+    def __len__(self):
+        return len(self.cur)
+
+    def update(self, values):
+        """
+        Add a measurement of every sensor to the table and update their cur,
+        min, max and average values.
+
+        min and max are the extremes seen so far, the average is kept as a
+        running sum over the window, so updating doesn't depend on the
+        window length.
+
+        Raise ValueError if there isn't exactly one value per sensor.
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape != self.cur.shape:
+            raise ValueError("Expected {} values, got {}".format(len(self), values.size))
+
+        queue_length = len(self.buffers)
+        full = self.count == queue_length
+        if not full:
+            self.count += 1
+
+        if update_stats is not None:
+            update_stats(self.buffers, self.head, full, values, self.cur,
+                         self.min, self.max, self.sum, self.samples, self.avg)
+        else:
+            row = self.buffers[self.head]
+            if full:
+                evicted = ~np.isnan(row)
+                np.subtract(self.sum, row, out=self.sum, where=evicted)
+                self.samples -= evicted
+
+            # Sum the values as stored, so that evicting them later is exact
+            row[:] = values
+            valid = ~np.isnan(row)
+            np.add(self.sum, row, out=self.sum, where=valid)
+            self.samples += valid
+
+            self.cur[:] = values
+            # fmin/fmax ignore NaN values like the comparisons of the kernel
+            np.fmin(self.min, self.cur, out=self.min)
+            np.fmax(self.max, self.cur, out=self.max)
+            self.update_avg()
+
+        self.head = (self.head + 1) % queue_length
+
+        if self.head == 0:
+            # Once per lap around the buffer, resync the running sum so that
+            # rounding errors can't build up over a long session
+            window = self.buffers[:self.count]
+            np.nansum(window, axis=0, dtype=np.float64, out=self.sum)
+            self.samples[:] = np.count_nonzero(~np.isnan(window), axis=0)
+            self.update_avg()
+
+    def update_avg(self):
+        """
+        Update the average of every sensor from its running sum, as NaN for
+        the sensors without any valid sample in the window.
+        """
+
+        with np.errstate(invalid="ignore"):
+            np.divide(self.sum, self.samples, out=self.avg)
@@ -6,25 +6,46 @@ The function of cpu_msr is to gather data from the CPU MSR pseudo-devices.
 Hint: run `modprobe msr` before running this module.
 """
 
+import atexit
+import os
 import struct
 
+MSR_PATH = '/dev/cpu/{}/msr'
+
+# File descriptors of the MSR pseudo-devices of every core, opened on first use
+msr_fds = {}
+
+unpack_register = struct.Struct('<Q').unpack_from
+
 def get_msr_register(register, core):
     """
     Read a register from the MSR pseudo-device. Needs MSR support from the
     Kernel and the CPU.
+
+    The pseudo-device is kept open and read with a single pread() at the
+    register's offset.
     """
 
-    msr_path = '/dev/cpu/{}/msr'.format(core)
+    fd = msr_fds.get(core)
+    if fd is None:
+        try:
+            fd = os.open(MSR_PATH.format(core), os.O_RDONLY)
+        except PermissionError:
+            return
+        msr_fds[core] = fd
+
+    return unpack_register(os.pread(fd, 8, register))[0]
+
+def close_msr_files():
+    """
+    Close the MSR pseudo-devices opened so far.
+    """
 
-    try:
-        with open(msr_path, mode='rb') as f:
-            f.seek(register)
-            value = f.read(8)
-            value = struct.unpack('<Q', value)[0]
-    except PermissionError:
-        return
+    for fd in msr_fds.values():
+        os.close(fd)
+    msr_fds.clear()
 
-    return value
+atexit.register(close_msr_files)
 
 def get_vccin(core):
     """
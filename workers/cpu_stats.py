@@ -0,0 +1,126 @@
+"""
+This module is part of sense.py.
+
+The function of cpu_stats is to read CPU statistics straight from the kernel
+pseudo-files, without going through psutil on every update.
+"""
+
+import os
+
+FREQ_PATH = "/sys/devices/system/cpu/cpu{}/cpufreq/scaling_cur_freq"
+STAT_PATH = "/proc/stat"
+CPUINFO_PATH = "/proc/cpuinfo"
+
+# File descriptors of the scaling_cur_freq files, opened on first use. An
+# empty list means that there's no cpufreq support and /proc/cpuinfo is read
+# instead.
+freq_fds = None
+
+# File descriptor of /proc/stat and the (busy, total) times of every core
+# read from it on the previous call
+stat_fd = None
+stat_times = None
+
+
+def open_freq_files(cpu_count):
+    """
+    Open the scaling_cur_freq file of every core. Return an empty list if
+    any of them can't be opened.
+    """
+
+    fds = []
+    try:
+        for core in range(cpu_count):
+            fds.append(os.open(FREQ_PATH.format(core), os.O_RDONLY))
+    except OSError:
+        for fd in fds:
+            os.close(fd)
+        return []
+
+    return fds
+
+
+def get_cpu_freqs(cpu_count):
+    """
+    Get the current frequency of every core in MHz.
+
+    The cpufreq files are kept open and re-read with a single pread() each,
+    sysfs regenerates their contents on every read from offset 0. Without
+    cpufreq, e.g. in virtual machines, the frequencies are parsed from
+    /proc/cpuinfo instead.
+    """
+
+    global freq_fds
+
+    if freq_fds is None:
+        freq_fds = open_freq_files(cpu_count)
+
+    if not freq_fds:
+        return read_cpuinfo_freqs()
+
+    return [int(os.pread(fd, 16, 0)) / 1000 for fd in freq_fds]
+
+
+def read_cpuinfo_freqs():
+    """
+    Get the frequency of every core in MHz as listed in /proc/cpuinfo.
+    """
+
+    with open(CPUINFO_PATH, "rb") as f:
+        cpuinfo = f.read()
+
+    return [float(line.split(b":")[1])
+            for line in cpuinfo.splitlines()
+            if line.startswith(b"cpu MHz")]
+
+
+def read_cpu_times(cpu_count):
+    """
+    Return a list of (busy, total) jiffies of every core as listed in
+    /proc/stat.
+    """
+
+    global stat_fd
+
+    if stat_fd is None:
+        stat_fd = os.open(STAT_PATH, os.O_RDONLY)
+
+    # The per-core lines come right after the aggregated "cpu" line, reading
+    # past them would only format the interrupt counters for nothing
+    stat = os.pread(stat_fd, 256 * (cpu_count + 1), 0)
+
+    times = []
+    for line in stat.splitlines()[1:]:
+        if not line.startswith(b"cpu"):
+            break
+
+        # user nice system idle iowait irq softirq steal, guest time is
+        # already accounted in user and nice
+        fields = [int(field) for field in line.split()[1:9]]
+        total = sum(fields)
+        times.append((total - fields[3] - fields[4], total))
+
+    return times
+
+
+def get_cpu_usages(cpu_count):
+    """
+    Get the usage of every core in percent since the previous call, like
+    psutil.cpu_percent(percpu=True) but from a single pread() of /proc/stat.
+    """
+
+    global stat_times
+
+    times = read_cpu_times(cpu_count)
+    last_times = stat_times or times
+    stat_times = times
+
+    usages = []
+    for (busy, total), (last_busy, last_total) in zip(times, last_times):
+        if total > last_total:
+            usage = 100 * (busy - last_busy) / (total - last_total)
+            usages.append(min(max(usage, 0.0), 100.0))
+        else:
+            usages.append(0.0)
+
+    return usages
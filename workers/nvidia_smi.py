@@ -1,83 +1,281 @@
 """
 This module is part of the sense project.
 
-Parse an nVidia info log via nvidia-smi
+Get the status of the nVidia GPU(s) via NVML when pynvml is installed, or
+query it from nvidia-smi otherwise.
 """
+import math
 import subprocess
-import xml.etree.ElementTree as etree
+import threading
 
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
 
-def get_nvidia_smi_log():
+
+# Name, unit and type of the reported sensors of every GPU
+GPU_SENSORS = (
+    ("Temperature", " °C", "temp"),
+    ("Fan PWM", " %", "usage"),
+    ("Usage", " %", "usage"),
+    ("VRAM Usage", " %", "usage"),
+    ("Encoder Usage", " %", "usage"),
+    ("Decoder Usage", " %", "usage"),
+    ("Graphics Clock", " MHz", "usage"),
+    ("SM Clock", " MHz", "usage"),
+    ("Memory Clock", " MHz", "usage"),
+    ("Video Clock", " MHz", "usage"),
+)
+
+# nvidia-smi query for the index and name of every GPU followed by the
+# values of GPU_SENSORS, one GPU per line
+QUERY_COMMAND = [
+    "nvidia-smi",
+    "--query-gpu=index,name,temperature.gpu,fan.speed,utilization.gpu,"
+    "utilization.memory,utilization.encoder,utilization.decoder,clocks.gr,"
+    "clocks.sm,clocks.mem,clocks.video",
+    "--format=csv,noheader,nounits",
+]
+
+# NVML device handles, looked up on first use
+nvml_handles = None
+
+
+def make_gpu_info(gpu_index, model, values):
+    """
+    Return a dictionary with the status of a GPU from the values of its
+    sensors, in the order of GPU_SENSORS.
+    """
+
+    gpu_info = {"GPU ID": "GPU #{}: {}".format(gpu_index, model)}
+    for (sensor, unit, s_type), value in zip(GPU_SENSORS, values):
+        gpu_info[sensor] = {"value": value, "unit": unit, "type": s_type}
+
+    return gpu_info
+
+
+def init_nvml():
+    """
+    Initialize NVML and look up the GPU handles. Return whether NVML can be
+    used, which needs both pynvml and the NVML library of the driver.
+    """
+
+    global nvml_handles
+
+    if nvml_handles is not None:
+        return True
+
+    if not pynvml:
+        return False
+
+    try:
+        pynvml.nvmlInit()
+    except pynvml.NVMLError:
+        return False
+
+    nvml_handles = [pynvml.nvmlDeviceGetHandleByIndex(i)
+                    for i in range(pynvml.nvmlDeviceGetCount())]
+    return True
+
+
+def get_nvml_log():
     """
-    Return a list of dictionaries with the nVidia GPU(s) status.
+    Return a list of dictionaries with the nVidia GPU(s) status, queried
+    directly from NVML. init_nvml() must have succeeded before.
     """
 
     out = []
 
-    smi_log = subprocess.check_output(["nvidia-smi", "-x", "-q"])
-    tree = etree.fromstring(smi_log)
-    get_text = lambda element, tag: element.find(tag).text
-
-    for gpu_index, gpu in enumerate(tree.findall("gpu")):
-        model = get_text(gpu, "product_name")
-        gpu_id = "GPU #{}: {}".format(gpu_index, model)
-        utilization = gpu.find("utilization")
-
-        gpu_info = {
-            "GPU ID": gpu_id,
-            "Temperature": {
-                "value": get_text(gpu.find("temperature"), "gpu_temp"),
-                "unit": " °C",
-                "type": "temp"
-            },
-            "Fan PWM": {
-                "value": get_text(gpu, "fan_speed"),
-                "unit": " %",
-                "type": "usage",
-            },
-            "Usage": {
-                "value": get_text(utilization, "gpu_util"),
-                "unit": " %",
-                "type": "usage"
-            },
-            "VRAM Usage": {
-                "value": get_text(utilization, "gpu_util"),
-                "unit": " %",
-                "type": "usage"
-            },
-            "Encoder Usage": {
-                "value": get_text(utilization, "encoder_util"),
-                "unit": " %",
-                "type": "usage"
-            },
-            "Decoder Usage": {
-                "value": get_text(utilization, "decoder_util"),
-                "unit": " %",
-                "type": "usage"
-            },
-
-            "Graphics Clock": {
-                "value": get_text(gpu.find("clocks"), "graphics_clock"),
-                "unit": " MHz",
-                "type": "usage"
-            },
-            "SM Clock": {
-                "value": get_text(gpu.find("clocks"), "sm_clock"),
-                "unit": " MHz",
-                "type": "usage"
-            },
-            "Memory Clock": {
-                "value": get_text(gpu.find("clocks"), "mem_clock"),
-                "unit": " MHz",
-                "type": "usage"
-            },
-            "Video Clock": {
-                "value": get_text(gpu.find("clocks"), "video_clock"),
-                "unit": " MHz",
-                "type": "usage"
-            },
-        }
-
-        out.append(gpu_info)
+    for gpu_index, handle in enumerate(nvml_handles):
+        model = pynvml.nvmlDeviceGetName(handle)
+        if isinstance(model, bytes):
+            model = model.decode()
+
+        try:
+            utilization = pynvml.nvmlDeviceGetUtilizationRates(handle)
+            usages = (utilization.gpu, utilization.memory)
+        except pynvml.NVMLError:
+            usages = (math.nan, math.nan)
+
+        clocks = [nvml_value(lambda: pynvml.nvmlDeviceGetClockInfo(handle, clock))
+                  for clock in (pynvml.NVML_CLOCK_GRAPHICS, pynvml.NVML_CLOCK_SM,
+                                pynvml.NVML_CLOCK_MEM, pynvml.NVML_CLOCK_VIDEO)]
+
+        values = (
+            nvml_value(lambda: pynvml.nvmlDeviceGetTemperature(
+                handle, pynvml.NVML_TEMPERATURE_GPU)),
+            nvml_value(lambda: pynvml.nvmlDeviceGetFanSpeed(handle)),
+            *usages,
+            nvml_value(lambda: pynvml.nvmlDeviceGetEncoderUtilization(handle)[0]),
+            nvml_value(lambda: pynvml.nvmlDeviceGetDecoderUtilization(handle)[0]),
+            *clocks,
+        )
+
+        out.append(make_gpu_info(gpu_index, model, [float(v) for v in values]))
 
     return out
+
+
+def nvml_value(query):
+    """
+    Return the value returned by `query`, a call to NVML, or NaN if the GPU
+    doesn't support it, e.g. the fan speed of a fanless GPU.
+    """
+
+    try:
+        return query()
+    except pynvml.NVMLError:
+        return math.nan
+
+
+def query_nvidia_smi():
+    """
+    Return a list of dictionaries with the nVidia GPU(s) status as queried
+    from nvidia-smi, or an empty list if nvidia-smi fails.
+    """
+
+    result = subprocess.run(QUERY_COMMAND, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, check=False)
+    if result.returncode != 0:
+        return []
+
+    try:
+        return [parse_gpu_query(line) for line in result.stdout.splitlines()]
+    except ValueError:
+        return []
+
+
+def parse_gpu_query(line):
+    """
+    Return a dictionary with the status of a GPU from a line of the output
+    of QUERY_COMMAND. Raise ValueError if the line isn't a GPU status, e.g.
+    an error message of nvidia-smi.
+    """
+
+    gpu_index, model, *values = line.decode().strip().split(", ")
+    if len(values) != len(GPU_SENSORS):
+        raise ValueError("Unexpected nvidia-smi output: {!r}".format(line))
+
+    return make_gpu_info(int(gpu_index), model, [parse_value(value) for value in values])
+
+
+def parse_value(value):
+    """
+    Return a sensor value reported by nvidia-smi as a float, or NaN for the
+    sensors the GPU doesn't have, which are reported as "[N/A]" or
+    "[Not Supported]".
+    """
+
+    if value.startswith("["):
+        return math.nan
+
+    return float(value)
+
+
+def open_gpu_log(interval=1):
+    """
+    Return a source of the GPU(s) status with a latest() and a close()
+    method: NVML when it's available, a long-running nvidia-smi process
+    otherwise. Return None if no GPU can be queried.
+    """
+
+    if init_nvml():
+        if nvml_handles:
+            return NvmlLog()
+        NvmlLog().close()
+
+    # A first one-off query tells whether there's any GPU at all
+    gpus = query_nvidia_smi()
+    if not gpus:
+        return None
+
+    return NvidiaSmiStream(gpus, interval)
+
+
+class NvmlLog:
+    """
+    Query the GPU(s) status from NVML every time it's asked for, which
+    doesn't need to spawn any process.
+    """
+
+    def latest(self):
+        """
+        Return the current GPU status.
+        """
+
+        return get_nvml_log()
+
+    def close(self):
+        """
+        Release NVML.
+        """
+
+        global nvml_handles
+
+        if nvml_handles is not None:
+            pynvml.nvmlShutdown()
+            nvml_handles = None
+
+
+class NvidiaSmiStream:
+    """
+    Keep a single nvidia-smi process running in loop mode and hold on to
+    the last GPU status it reported, so that polling it doesn't fork a new
+    process every time.
+    """
+
+    def __init__(self, gpus, interval=1):
+        # The status of a first one-off query tells how many lines make up a
+        # report, and is returned until the loop has reported one
+        self.gpus = gpus
+
+        interval_ms = str(max(1, round(interval * 1000)))
+        self.process = subprocess.Popen(QUERY_COMMAND + ["-lms", interval_ms],
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+
+        reader = threading.Thread(target=self.read_reports, daemon=True)
+        reader.start()
+
+    def read_reports(self):
+        """
+        Parse every report printed by nvidia-smi as soon as it's complete.
+
+        Lines that aren't a GPU status, or that are out of step with the
+        order of the GPUs, discard the report being read, and reading
+        resumes with the first GPU of the next one.
+        """
+
+        gpus = []
+        for line in self.process.stdout:
+            try:
+                gpu = parse_gpu_query(line)
+            except ValueError:
+                gpus = []
+                continue
+
+            if gpu["GPU ID"] != self.gpus[len(gpus)]["GPU ID"]:
+                gpus = []
+                if gpu["GPU ID"] != self.gpus[0]["GPU ID"]:
+                    continue
+
+            gpus.append(gpu)
+            if len(gpus) == len(self.gpus):
+                self.gpus = gpus
+                gpus = []
+
+    def latest(self):
+        """
+        Return the last reported GPU status.
+        """
+
+        return self.gpus
+
+    def close(self):
+        """
+        Stop the nvidia-smi process.
+        """
+
+        self.process.terminate()
+        self.process.wait()